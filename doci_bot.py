@@ -1,11 +1,16 @@
 import os
+import re
+import heapq
 import asyncio
 import traceback
+from collections import deque, OrderedDict
 from html import escape
 from pprint import pprint
 import yaml
+import orjson
 
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.enums import ParseMode
@@ -49,6 +54,11 @@ class Config:
     FAISS_ROOT = os.path.join(os.getcwd(), "DB_FAISS")
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     DEFAULT_K = 4
+    QUERY_CACHE_SIZE = 4096  # LRU-кэш эмбеддингов запросов
+    ASSEMBLED_CACHE_SIZE = 1024  # LRU-кэш собранных статей
+    INDEX_CODEC = "SQ8"  # Квантование векторов при загрузке ("SQfp16" или None - без сжатия)
+    CATEGORIES = []  # Заполняется в on_startup
+    FAISS_PATHS = {}  # Категория -> список папок с .faiss
 
 # Валидация структуры файла
 class PromptsSchema(BaseModel):
@@ -100,19 +110,119 @@ class PromptManager:
         }
 
 # config = Config()
-bot = Bot(token=Config.BOT_TOKEN)
+# orjson вместо стандартного json для разбора апдейтов и сериализации запросов к API
+bot = Bot(
+    token=Config.BOT_TOKEN,
+    session=AiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda obj: orjson.dumps(obj).decode()
+    )
+)
 dp = Dispatcher()
 processor = DBConstructor()
 user_sessions = {}
+assembled_cache = OrderedDict()  # (категория, chunk_id) -> собранная статья
+background_tasks = set()  # Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+preloaded_dbs = {}  # Категория -> {"indexes", "chunk_by_id", "query_prefix"}, общий для всех пользователей
 prompt_manager = PromptManager()  # Читает prompts.yaml в первый раз
 answer_generator = GCProcessor(prompt_manager.get_prompts()["model_name"])  # Берёт модель из файла
 
+def fire_and_forget(coro):
+    """Запускает корутину в фоне, не дожидаясь результата (служебные вызовы к Telegram)"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
 # ====================== Инициализация ======================
+def scan_faiss_root(root: str) -> dict:
+    """Однократный обход FAISS_ROOT: категория -> папки с .faiss"""
+    faiss_paths = {}
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                faiss_paths[entry.name] = [
+                    d for d, _, files in os.walk(entry.path)
+                    if any(file.endswith(".faiss") for file in files)
+                ]
+    return faiss_paths
+
+async def load_index(faiss_dir: str, progress: dict) -> dict:
+    """Загрузка одного индекса в отдельном потоке с учётом в общем счётчике"""
+    load_result = await asyncio.to_thread(processor.faiss_loader, faiss_dir, hybrid_mode=False)
+    progress["done"] += 1
+    return load_result
+
+async def report_progress(progress: dict, interval: float = 1.0):
+    """Периодически выводит прогресс загрузки, не блокируя сами загрузчики"""
+    while True:
+        await asyncio.sleep(interval)
+        print(f"🔄 Прогресс загрузки баз: {progress['done']}/{progress['total']}")
+
+async def load_category(category: str, faiss_paths: list, progress: dict) -> list:
+    """Параллельная загрузка всех индексов категории"""
+    load_results = await asyncio.gather(*(
+        load_index(faiss_dir, progress)
+        for faiss_dir in faiss_paths
+    ))
+
+    faiss_indexes = []
+    for faiss_dir, load_result in zip(faiss_paths, load_results):
+        if load_result["success"]:
+            faiss_indexes.append(load_result["db"])
+        else:
+            print(f"⚠️ Ошибка загрузки {faiss_dir}: {load_result['error']}")
+
+    print(f"📦 {category}: загружено {len(faiss_indexes)}/{len(faiss_paths)}")
+
+    # Все базы совместимы по эмбеддингам (проверено в set_embeddings),
+    # поэтому сливаем их в один индекс: один поиск вместо поиска по каждому
+    merged_db = await asyncio.to_thread(processor.merge_loaded_indexes, faiss_indexes)
+    if merged_db and Config.INDEX_CODEC:
+        merged_db = await asyncio.to_thread(processor.quantize_index, merged_db, Config.INDEX_CODEC)
+    return [merged_db] if merged_db else []
+
+def category_query_prefix(faiss_paths: list) -> str:
+    """Префикс запроса по метаданным базы категории ("query: " для E5-моделей)"""
+    if not faiss_paths:
+        return ""
+    _, meta = processor.metadata_loader(faiss_paths[0])
+    return "query: " if meta and meta.get("is_e5_model", False) else ""
+
+async def preload_databases():
+    """Однократная загрузка всех баз в общий реестр"""
+    categories = list(Config.FAISS_PATHS)
+    progress = {"done": 0, "total": sum(len(paths) for paths in Config.FAISS_PATHS.values())}
+
+    # Прогресс выводится отдельной задачей раз в секунду
+    reporter = asyncio.create_task(report_progress(progress))
+    try:
+        loaded = await asyncio.gather(*(
+            load_category(category, Config.FAISS_PATHS[category], progress)
+            for category in categories
+        ))
+    finally:
+        reporter.cancel()
+
+    for category, faiss_indexes in zip(categories, loaded):
+        preloaded_dbs[category] = {
+            "indexes": faiss_indexes,
+            "chunk_by_id": build_chunk_map(faiss_indexes),
+            "query_prefix": category_query_prefix(Config.FAISS_PATHS[category])
+        }
+
 async def on_startup(bot: Bot):
     print("🔄 Запуск инициализации эмбеддингов...")
 
     try:
-        set_embs_result = processor.set_embeddings(Config.FAISS_ROOT, verbose=False)
+        # Структура баз статична, сканируем её один раз
+        Config.FAISS_PATHS = scan_faiss_root(Config.FAISS_ROOT)
+        Config.CATEGORIES = list(Config.FAISS_PATHS)
+
+        set_embs_result = processor.set_embeddings(
+            Config.FAISS_ROOT,
+            verbose=False,
+            query_cache_size=Config.QUERY_CACHE_SIZE
+        )
         processor.db_metadata = set_embs_result["result"]["metadata"]
         pprint(processor.db_metadata)
 
@@ -123,6 +233,8 @@ async def on_startup(bot: Bot):
 
         print("✅ Эмбеддинги успешно загружены")
 
+        await preload_databases()
+        print("✅ Базы загружены")
 
     except Exception as e:
         print(f"💥 Критическая ошибка при запуске: {str(e)}")
@@ -132,10 +244,7 @@ async def on_startup(bot: Bot):
 @dp.message(Command("start"))
 async def start(message: types.Message):
     try:
-        categories = [
-            d for d in os.listdir(Config.FAISS_ROOT)
-            if os.path.isdir(os.path.join(Config.FAISS_ROOT, d))
-        ]
+        categories = Config.CATEGORIES
 
         if not categories:
             await message.answer("⚠️ Базы данных не найдены!")
@@ -197,59 +306,17 @@ async def handle_category(callback: types.CallbackQuery):
         user_id = callback.from_user.id
         category = callback.data.split("_", 1)[1]  # Исправлено разделение
 
-        # Инициализация сессии
-        user_sessions[user_id] = {
-            "faiss_indexes": [],  # Будет заполнено
-            "query_prefix": "",
-            "last_results": []  # Важно: создаем ключ заранее
-        }
-
-        # Убедимся, что путь существует
-        category_path = os.path.join(Config.FAISS_ROOT, category)
-        if not os.path.exists(category_path):
+        # Убедимся, что категория существует
+        if category not in preloaded_dbs:
             await callback.answer("❌ Категория не найдена", show_alert=True)
             return
 
-        # Показываем статус "Загрузка..."
-        await callback.answer("⏳ Загрузка...")
-
-        # Асинхронная загрузка баз
-        faiss_indexes = []
-        faiss_paths = [d for d, _, files in os.walk(category_path) for file in files if file.endswith(".faiss")]
-
-        print(faiss_paths)
-
-        # Прогресс-бар
-        progress_msg = await callback.message.answer("🔄 Прогресс: 0%")
+        # Сессия хранит только имя категории, индексы берутся из общего реестра
+        # Сессия собирается целиком и присваивается одним действием
+        session = {"category": category, "articles": []}
+        user_sessions[user_id] = session
 
-        for idx, faiss_dir in enumerate(faiss_paths):
-            # Загрузка в отдельном потоке
-            load_result = await asyncio.to_thread(
-                processor.faiss_loader,
-                faiss_dir,
-                hybrid_mode=False
-            )
-
-            if load_result["success"]:
-                faiss_indexes.append(load_result["db"])
-
-            # Обновление прогресса
-            progress = (idx + 1) / len(faiss_paths) * 100
-            await progress_msg.edit_text(f"🔄 Прогресс: {int(progress)}%")
-
-        # Сохраняем результат
-        user_sessions[user_id] = {
-            "faiss_indexes": faiss_indexes,
-            "query_prefix": "query: " if processor.db_metadata.get("is_e5_model", False) else ""
-        }
-
-        user_sessions[user_id].update({
-            "faiss_indexes": faiss_indexes,
-            "query_prefix": "query: " if processor.db_metadata.get("is_e5_model", False) else ""
-        })
-
-        # Удаляем сообщения
-        await progress_msg.delete()
+        fire_and_forget(callback.answer())  # Просто убирает индикатор загрузки у кнопки
         await callback.message.answer(f"✅ База '{category}' готова к поиску!")
 
     except Exception as e:
@@ -268,42 +335,41 @@ async def handle_query(message: types.Message):
         # Отправляем индикатор поиска
         search_msg = await message.answer("⏳ Ищу ответ в документах...")
 
-        # Получаем контекст пользователя
+        # Получаем контекст пользователя и базу его категории
         session = user_sessions[user_id]
+        db = preloaded_dbs[session["category"]]
 
         # Выполняем поиск
         raw_results = await processor.multi_async_search(
-            query=session["query_prefix"] + message.text,
-            indexes=session["faiss_indexes"],
+            query=db["query_prefix"] + message.text,
+            indexes=db["indexes"],
             search_function=processor.aformatted_scored_sim_search_by_cos,
             k=Config.DEFAULT_K
         )
 
-        # Сортировка и фильтрация найденных чанков
-        sorted_results = sorted(
-            raw_results,
-            key=lambda x: x["score"],
-            reverse=True
-        )[:3]  # Топ-3 результата
+        # Топ-3 результата без полной сортировки
+        sorted_results = heapq.nlargest(3, raw_results, key=lambda x: x["score"])
 
         # Собираем полные статьи для всех результатов
-        session["articles"] = []
+        articles = []
         for result in sorted_results:
-            full_content = await assemble_full_content(
+            full_content = await get_full_content(
+                category=session["category"],
                 main_chunk=result,
-                faiss_indexes=session["faiss_indexes"]
+                chunk_by_id=db["chunk_by_id"]
             )
-            session["articles"].append({
+            articles.append({
                 "title": result["metadata"].get("_title", "Без названия"),
                 "content": full_content,
                 "score": result["score"],
                 "element_type": result["metadata"].get("element_type", "text")
             })
+        session["articles"] = articles  # Публикуем список целиком, без промежуточных состояний
 
         # Формируем промпт для модели
         user_prompt = "\n\n".join(
             f"Статья {i + 1} ({art['score']:.0%}): {art['title']}\n{art['content'][:1500]}..."
-            for i, art in enumerate(session["articles"])
+            for i, art in enumerate(articles)
         )
 
         prompts = prompt_manager.get_prompts()
@@ -319,11 +385,11 @@ async def handle_query(message: types.Message):
         )
 
         # Удаляем индикатор поиска.
-        await search_msg.delete()
+        fire_and_forget(search_msg.delete())
 
         # Создаем кнопки для источников
         builder = InlineKeyboardBuilder()
-        for idx, art in enumerate(session["articles"]):
+        for idx, art in enumerate(articles):
             builder.button(
                 text=f"{art['title']} ({art['score']:.0%})",
                 callback_data=f"show_article_{idx}"
@@ -348,7 +414,7 @@ async def handle_article_selection(callback: types.CallbackQuery):
         user_id = callback.from_user.id
         session = user_sessions.get(user_id)
 
-        if not session or "articles" not in session:
+        if not session or not session["articles"]:
             await callback.answer("❌ Сессия устарела. Выполните новый поиск.")
             return
 
@@ -372,45 +438,60 @@ async def handle_article_selection(callback: types.CallbackQuery):
         print(f"CALLBACK ERROR: {str(e)}")
         traceback.print_exc()
 
-async def assemble_full_content(main_chunk: dict, faiss_indexes: list) -> str:
+def chunk_sort_key(chunk_id: str) -> tuple:
+    """Натуральный ключ сортировки: doc1_p2 идёт раньше doc1_p10"""
+    return tuple(int(s) if s.isdigit() else s for s in re.split(r"(\d+)", chunk_id))
+
+def build_chunk_map(faiss_indexes: list) -> dict:
+    """Строит словарь chunk_id -> чанк по всем индексам (один проход по docstore)"""
+    chunk_by_id = {}
+    for index in faiss_indexes:
+        for doc in index.docstore._dict.values():
+            # Ключ сортировки и очищенный от E5-префикса текст считаем один раз при загрузке
+            doc.metadata["_sort_key"] = chunk_sort_key(doc.metadata["chunk_id"])
+            doc.metadata["_clean_content"] = doc.page_content.replace("passage:", "").strip()
+            chunk_by_id[doc.metadata["chunk_id"]] = doc
+    return chunk_by_id
+
+async def get_full_content(category: str, main_chunk: dict, chunk_by_id: dict) -> str:
+    """Собранная статья из LRU-кэша; граф чанков статичен, поэтому результат детерминирован"""
+    key = (category, main_chunk["metadata"]["chunk_id"])
+    if key in assembled_cache:
+        assembled_cache.move_to_end(key)
+        return assembled_cache[key]
+
+    content = await assemble_full_content(main_chunk, chunk_by_id)
+    assembled_cache[key] = content
+    if len(assembled_cache) > Config.ASSEMBLED_CACHE_SIZE:
+        assembled_cache.popitem(last=False)
+    return content
+
+async def assemble_full_content(main_chunk: dict, chunk_by_id: dict) -> str:
     """Сборка полного контента из связанных чанков"""
     chunks = []
-    visited = set()
-    queue = [main_chunk["metadata"]["chunk_id"]]
+    start_id = main_chunk["metadata"]["chunk_id"]
+    visited = {start_id}  # Помечаем при постановке в очередь: каждый chunk_id попадает в неё один раз
+    queue = deque([start_id])
 
     while queue:
-        chunk_id = queue.pop(0)
-        if chunk_id in visited:
+        chunk_id = queue.popleft()
+
+        # Поиск чанка по карте chunk_id
+        chunk = chunk_by_id.get(chunk_id)
+        if not chunk:
             continue
 
-        # Поиск чанка во всех индексах
-        chunk = None
-        for index in faiss_indexes:
-            chunk = next(
-                (doc for doc in index.docstore._dict.values()
-                 if doc.metadata["chunk_id"] == chunk_id),
-                None
-            )
-            if chunk:
-                break
-
-        if chunk:
-            chunks.append(chunk)
-            visited.add(chunk_id)
-            queue.extend(
-                linked_id
-                for linked_id in chunk.metadata.get("linked", [])
-                if linked_id not in visited
-            )
+        chunks.append(chunk)
+        for linked_id in chunk.metadata.get("linked", []):
+            if linked_id not in visited:
+                visited.add(linked_id)
+                queue.append(linked_id)
 
-    # Сортировка по порядку chunk_id (пример: doc1_p1, doc1_p2)
-    chunks.sort(key=lambda x: x.metadata["chunk_id"])
+    # Сортировка по порядку chunk_id (пример: doc1_p_2, doc1_p_10)
+    chunks.sort(key=lambda x: x.metadata["_sort_key"])
 
     # Сборка контента
-    return "\n\n".join(
-        chunk.page_content.replace("passage:", "").strip()
-        for chunk in chunks
-    )
+    return "\n\n".join(chunk.metadata["_clean_content"] for chunk in chunks)
 
 def format_response(main_chunk: dict, content: str) -> str:
     """Форматирование в зависимости от типа"""
@@ -447,11 +528,21 @@ async def send_long_message(
                 current_part = []
                 current_len = 0
 
-            # Обработка очень длинных абзацев
-            while para_len > max_length:
-                parts.append(paragraph[:max_length])
-                paragraph = paragraph[max_length:]
-                para_len = len(paragraph)
+            # Обработка очень длинных абзацев: режем по индексам, без копирования хвоста
+            start = 0
+            while para_len - start > max_length:
+                end = start + max_length
+                cut = end
+                # Ищем ближайший разрыв строки, пробел или конец предложения
+                for i in range(end - 1, max(end - 200, start), -1):
+                    if paragraph[i] in "\n .":
+                        cut = i + 1
+                        break
+                parts.append(paragraph[start:cut])
+                start = cut
+
+            paragraph = paragraph[start:]
+            para_len = len(paragraph)
 
         if para_len > 0:
             current_part.append(paragraph)
@@ -480,6 +571,14 @@ if __name__ == "__main__":
     print(f"🔑 Токен бота: {'установлен' if Config.BOT_TOKEN else 'отсутствует!'}")
     print(f"📁 Путь к базам: {Config.FAISS_ROOT}")
 
+    # uvloop быстрее стандартного цикла asyncio (нет под Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print("⚡ Цикл событий: uvloop")
+    except ImportError:
+        print("ℹ️ Цикл событий: asyncio (uvloop не установлен)")
+
     try:
         asyncio.run(dp.start_polling(
             bot,
@@ -19,11 +19,14 @@ import tiktoken
 # from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+import faiss
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.embeddings import Embeddings
 
 import functools
 import asyncio
+import threading
+from collections import OrderedDict
 from sentence_transformers import SentenceTransformer
 
 import re                 # работа с регулярными выражениями
@@ -174,6 +177,34 @@ class MetaCompatibilityError(Exception):
     def __init__(self, message="Метаданные несовместимы."):
         super().__init__(message)
 
+class CachedEmbeddings(Embeddings):
+    """Обёртка над моделью эмбеддингов с LRU-кэшем векторов запросов."""
+
+    def __init__(self, embeddings: Embeddings, maxsize: int = 4096):
+        self.embeddings = embeddings
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # Поиск идёт из нескольких потоков (asyncio.to_thread)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # Нормализуем пробелы, чтобы незначительно отличающиеся запросы давали одно попадание
+        key = " ".join(text.split())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        vector = self.embeddings.embed_query(key)
+
+        with self._lock:
+            self._cache[key] = vector
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)  # Вытесняем самый давний запрос
+        return vector
+
 class DBConstructor(RAGProcessor):
     def __init__(self, embeddings=None):
         super().__init__()
@@ -191,6 +222,7 @@ class DBConstructor(RAGProcessor):
         self.answer = None
         self.unprocessed_text = None
         self.processed_text = None
+        self._hf_embeddings_cache = {}  # (model_name, normalize) -> HuggingFaceEmbeddings
 
     @staticmethod
     def async_wrapper(method):
@@ -908,11 +940,34 @@ class DBConstructor(RAGProcessor):
             result["error"] = str(e)
             return result
 
-    def set_embeddings(self, db_folder: str, verbose: bool = False):
+    @staticmethod
+    def quantize_index(db: FAISS, codec: str = "SQ8") -> FAISS:
+        """
+        Пересжимает векторы загруженной базы скалярным квантованием (fp32 -> int8/fp16).
+        Модель эмбеддингов не меняется: векторы восстанавливаются из индекса и кодируются заново.
+        :param db: FAISS-база из langchain с плоским (Flat) индексом
+        :param codec: Строка index_factory: "SQ8" (int8, в 4 раза меньше памяти) или "SQfp16"
+        :return: Та же база с квантованным индексом
+        """
+        index = db.index
+        if not isinstance(index, faiss.IndexFlat) or index.ntotal == 0:
+            return db
+
+        vectors = index.reconstruct_n(0, index.ntotal)
+        quantized = faiss.index_factory(index.d, codec, index.metric_type)
+        quantized.train(vectors)
+        quantized.add(vectors)
+
+        # Порядок векторов сохранён, поэтому index_to_docstore_id остаётся валидным
+        db.index = quantized
+        return db
+
+    def set_embeddings(self, db_folder: str, verbose: bool = False, query_cache_size: int = 0):
         """
         Загружает модель эмбеддингов и проверяет метаданные.
         :param db_folder: Путь к папке с базой
         :param verbose: Распечатка результатов при отладке
+        :param query_cache_size: Размер LRU-кэша эмбеддингов запросов (0 - без кэша)
         :return: Словарь с результатами
         """
         result = {
@@ -950,6 +1005,8 @@ class DBConstructor(RAGProcessor):
             embs_code, self.embeddings = self._load_embeddings(current_meta)
             load_embs = f"_load_embeddings: {embs_code}."
             if self.embeddings is None: raise EmbeddingsNotInitialized("Модель эмбеддингов не загружена")
+            if query_cache_size > 0:
+                self.embeddings = CachedEmbeddings(self.embeddings, maxsize=query_cache_size)
 
             result["result"].update({"loaded": [load_meta, load_embs], "metadata": current_meta})
 
@@ -1174,6 +1231,23 @@ class DBConstructor(RAGProcessor):
 
         return merged_db
 
+    @staticmethod
+    def merge_loaded_indexes(indexes: List[FAISS]) -> Optional[FAISS]:
+        """
+        Объединяет уже загруженные FAISS-индексы в один (в памяти, без записи на диск).
+        Индексы должны быть построены одной моделью эмбеддингов.
+        :param indexes: Список FAISS-индексов. Первый индекс дополняется остальными.
+        :return: Объединённый индекс или None, если список пуст
+        """
+        if not indexes:
+            return None
+
+        merged_db = indexes[0]
+        for index in indexes[1:]:
+            merged_db.merge_from(index)
+
+        return merged_db
+
     @staticmethod
     def _save_merged_metadata(output_folder: str, meta: dict):
         """Создает расширенные метаданные для объединенной базы"""
@@ -1302,15 +1376,8 @@ class DBConstructor(RAGProcessor):
         """Поиск с оценкой релевантности. Возвращает топ-3 текста и таблицы."""
         result = {"texts": [], "tables": []}
 
-        embs_txt = HuggingFaceEmbeddings(
-            model_name="ai-forever/sbert_large_nlu_ru",
-            encode_kwargs={"normalize_embeddings": True}
-        )
-
-        embs_tab = HuggingFaceEmbeddings(
-            model_name="deepset/all-mpnet-base-v2-table",
-            encode_kwargs={"normalize_embeddings": False}
-        )
+        embs_txt = self._get_hf_embeddings("ai-forever/sbert_large_nlu_ru", normalize=True)
+        embs_tab = self._get_hf_embeddings("deepset/all-mpnet-base-v2-table", normalize=False)
 
         query_txt = embs_txt.embed_query(query)
         query_tab = embs_tab.embed_query(query)
@@ -1341,6 +1408,16 @@ class DBConstructor(RAGProcessor):
 
         return result
 
+    def _get_hf_embeddings(self, model_name: str, normalize: bool) -> HuggingFaceEmbeddings:
+        """Модель эмбеддингов создаётся один раз на экземпляр и переиспользуется между запросами"""
+        key = (model_name, normalize)
+        if key not in self._hf_embeddings_cache:
+            self._hf_embeddings_cache[key] = HuggingFaceEmbeddings(
+                model_name=model_name,
+                encode_kwargs={"normalize_embeddings": normalize}
+            )
+        return self._hf_embeddings_cache[key]
+
     @staticmethod
     def formatted_scored_sim_search_by_cos(index: Optional[FAISS], query: str, **search_args) -> list:
         """